@@ -1,13 +1,319 @@
+import time
+PROCESS_STARTED = time.monotonic()  # taken before the other imports so startup timing includes them
+
 import os
+import sys
 import json
-import httpx
+import hmac
+import uuid
+import signal
+import asyncio
+import importlib
+import threading
+from collections import Counter, OrderedDict, deque
+from contextlib import asynccontextmanager
 from datetime import datetime
-from fastapi import FastAPI, HTTPException, Header
+from functools import lru_cache
+from fastapi import FastAPI, HTTPException, Header, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
 from pydantic import BaseModel
 from typing import List, Optional
 
-app = FastAPI()
+# --- PROFILING SETTINGS (Render env vars) ---
+# Profiling endpoints stay disabled unless PROFILING_TOKEN is set.
+PROFILING_TOKEN = os.getenv("PROFILING_TOKEN", "")
+BACKGROUND_SAMPLE_INTERVAL = float(os.getenv("PROFILE_BACKGROUND_INTERVAL", "0.1"))  # 10 Hz, always on
+BACKGROUND_MAX_SAMPLES = int(os.getenv("PROFILE_BACKGROUND_SAMPLES", "6000"))  # ~10 minutes at 10 Hz
+REQUEST_SAMPLE_INTERVAL = float(os.getenv("PROFILE_REQUEST_INTERVAL", "0.002"))
+REQUEST_MAX_SAMPLES = int(os.getenv("PROFILE_REQUEST_MAX_SAMPLES", "5000"))  # last ~10s of a request at 500 Hz
+MAX_REQUEST_PROFILES = int(os.getenv("PROFILE_MAX_STORED", "20"))
+LOOP_LAG_INTERVAL = 0.05
+LOOP_LAG_THRESHOLD = float(os.getenv("LOOP_LAG_THRESHOLD_MS", "100")) / 1000
+
+# --- PROFILING ---
+def capture_stack(frame):
+    """Returns the stack as a tuple of code objects, outermost first. Cheap to take and to compare."""
+    codes = []
+    while frame is not None:
+        codes.append(frame.f_code)
+        frame = frame.f_back
+    return tuple(reversed(codes))
+
+def fold_codes(codes):
+    """Turns a captured stack into a 'outer;...;inner' line (collapsed-stack format used by flamegraph.pl / speedscope)."""
+    return ";".join(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})" for code in codes)
+
+def fold_stack(frame):
+    return fold_codes(capture_stack(frame))
+
+def fold_samples(samples):
+    counts = Counter(samples)
+    return "".join(f"{fold_codes(stack)} {count}\n" for stack, count in counts.most_common())
+
+class StackSampler:
+    """Samples one thread's stack from a daemon thread. Samples are kept in a bounded ring buffer.
+
+    Identical stacks (mostly the idle selector) are interned, so the buffer holds
+    references to a few shared tuples; text is only built on download.
+    """
+
+    def __init__(self, thread_id, interval, max_samples):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = deque(maxlen=max_samples)
+        self._interned = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                stack = capture_stack(frame)
+                if len(self._interned) > self.samples.maxlen:
+                    self._interned.clear()  # only loses sharing, never samples
+                self.samples.append(self._interned.setdefault(stack, stack))
+
+    def folded(self):
+        return fold_samples(list(self.samples))
+
+class LoopLagMonitor:
+    """Flags synchronous work that blocks the event loop.
+
+    A coroutine stamps a heartbeat every LOOP_LAG_INTERVAL. A watchdog thread
+    polls at a tenth of the threshold and grabs the loop thread's stack once the
+    loop is half a threshold past its expected wake-up, so the event records
+    *what* was blocking, not just for how long. A stack is only attached to the
+    stall whose heartbeat it was taken under.
+    """
+
+    def __init__(self, thread_id, interval, threshold, max_events=100):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.threshold = threshold
+        self.events = deque(maxlen=max_events)
+        self._heartbeat = time.monotonic()
+        self._stall = None  # (heartbeat, folded stack) captured by the watchdog
+        self._stop = threading.Event()
+        self._task = None
+        self._watchdog = threading.Thread(target=self._watch, name="loop-lag-watchdog", daemon=True)
+
+    def start(self):
+        self._task = asyncio.create_task(self._beat())
+        self._watchdog.start()
+        return self
+
+    async def stop(self):
+        self._stop.set()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._watchdog.join()
+
+    async def _beat(self):
+        self._heartbeat = time.monotonic()
+        while True:
+            await asyncio.sleep(self.interval)
+            heartbeat, now = self._heartbeat, time.monotonic()
+            self._heartbeat = now  # before anything else, so the watchdog never samples this coroutine
+            stall, self._stall = self._stall, None
+            lag = now - heartbeat - self.interval
+            if lag > self.threshold:
+                stack = stall[1] if stall and stall[0] == heartbeat else None
+                self.events.append({
+                    "at": datetime.now().isoformat(timespec="seconds"),
+                    "lag_ms": round(lag * 1000, 1),
+                    "stack": stack,
+                })
+                print(f"⚠️ EVENT LOOP BLOCKED for {lag * 1000:.0f} ms at: {stack}")
+
+    def _watch(self):
+        while not self._stop.wait(self.threshold / 10):
+            heartbeat = self._heartbeat
+            overdue = time.monotonic() - heartbeat - self.interval
+            if overdue <= self.threshold / 2 or (self._stall and self._stall[0] == heartbeat):
+                continue
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = fold_stack(frame)
+            if self._heartbeat == heartbeat:  # loop still hadn't woken, so the stack is the blocker
+                self._stall = (heartbeat, stack)
+
+profiling = {"background": None, "loop_lag": None, "loop_thread_id": None}
+request_profiles = OrderedDict()  # profile_id -> folded stacks, oldest evicted first
+
+# --- LIFECYCLE SETTINGS (Render env vars) ---
+# Render waits 30s after SIGTERM before killing the instance, so drain inside that window.
+DRAIN_DEADLINE = float(os.getenv("DRAIN_DEADLINE_S", "25"))
+RETRY_AFTER_S = "5"
+FBR_URL = "https://gw.fbr.gov.pk/di_data/v1/di/postinvoicedata_sb"
+FBR_WARMUP_URL = "https://gw.fbr.gov.pk/"
+# httpx drops idle connections after 5s by default; keep the warm one around and touch it
+# more often than that so a quiet instance still has it when the first submission lands.
+FBR_KEEPALIVE_EXPIRY = float(os.getenv("FBR_KEEPALIVE_EXPIRY_S", "300"))
+FBR_KEEPALIVE_REFRESH = float(os.getenv("FBR_KEEPALIVE_REFRESH_S", "60"))
+
+# --- LIFECYCLE ---
+# ready: warm-up finished and not draining. Liveness (/health) never depends on it.
+def fresh_lifecycle():
+    """Per-lifespan state; reset on every startup so a restarted app doesn't inherit a drained one."""
+    return {
+        "ready": False,
+        "draining": False,
+        "http_client": None,  # shared httpx.AsyncClient, created during warm-up
+        "client_lock": asyncio.Lock(),  # guards http_client creation
+        "warm_up": None,
+        "keep_warm": None,
+        "drain": None,
+        "previous_sigterm": None,
+        "in_flight": {},  # FBR call task -> invoice_id
+        "requeued": set(),  # FBR call tasks cancelled by the drain deadline
+        "ready_after_s": None,
+        "first_request_after_s": None,
+    }
+
+lifecycle = fresh_lifecycle()
+
+async def create_http_client():
+    # httpx import and client setup (ssl context, transport imports) are the slow parts; keep them off the event loop.
+    httpx = await asyncio.to_thread(importlib.import_module, "httpx")
+    limits = httpx.Limits(keepalive_expiry=FBR_KEEPALIVE_EXPIRY)
+    return await asyncio.to_thread(httpx.AsyncClient, timeout=30.0, limits=limits)
+
+async def keep_fbr_warm():
+    """Re-touches the FBR gateway so the pooled connection outlives quiet periods.
+
+    This guarantees a warm connection only while the gateway itself keeps idle
+    connections open for FBR_KEEPALIVE_REFRESH seconds; if it closes them sooner,
+    the next submission reconnects (DNS + TLS) as it would without pre-warming.
+    """
+    while not lifecycle["draining"]:
+        await asyncio.sleep(FBR_KEEPALIVE_REFRESH)
+        try:
+            await lifecycle["http_client"].head(FBR_WARMUP_URL, timeout=10.0)
+        except Exception as e:
+            print(f"⚠️ FBR keep-alive ping failed: {e!r}")
+
+async def warm_up():
+    """Pays cold-start costs in the background so /health answers immediately. Never raises."""
+    started = time.monotonic()
+    try:
+        get_client_config()
+        client = await get_http_client()
+        # Any response will do: the point is DNS + TLS handshake into the connection pool.
+        await client.head(FBR_WARMUP_URL, timeout=10.0)
+        lifecycle["keep_warm"] = asyncio.create_task(keep_fbr_warm())
+    except Exception as e:
+        print(f"⚠️ Warm-up incomplete (first submission will connect cold): {e!r}")
+    lifecycle["ready"] = not lifecycle["draining"]
+    lifecycle["ready_after_s"] = round(time.monotonic() - PROCESS_STARTED, 3)
+    print(f"✅ READY after {lifecycle['ready_after_s']}s (warm-up took {time.monotonic() - started:.3f}s)")
+
+async def get_http_client():
+    # Shared by warm-up and submissions: an early submission waits for the client only,
+    # never for the warm-up probe, and a failed warm-up is retried here.
+    async with lifecycle["client_lock"]:
+        if lifecycle["http_client"] is None:
+            lifecycle["http_client"] = await create_http_client()
+    return lifecycle["http_client"]
+
+def record_first_request():
+    if lifecycle["ready"] and lifecycle["first_request_after_s"] is None:
+        lifecycle["first_request_after_s"] = round(time.monotonic() - PROCESS_STARTED, 3)
+        print(f"⏱️ FIRST SUBMISSION after {lifecycle['first_request_after_s']}s")
+
+async def drain(deadline):
+    """Waits for in-flight FBR calls; those still running at the deadline are cancelled and the client is told to resubmit."""
+    print(f"🛑 DRAINING: {len(lifecycle['in_flight'])} in-flight submission(s), deadline {deadline}s")
+    end = time.monotonic() + deadline
+    while lifecycle["in_flight"] and time.monotonic() < end:
+        await asyncio.sleep(0.1)
+    for call, invoice_id in list(lifecycle["in_flight"].items()):
+        print(f"↩️ RE-QUEUED invoice {invoice_id}: drain deadline hit, client asked to resubmit")
+        lifecycle["requeued"].add(call)
+        call.cancel()
+    while lifecycle["in_flight"]:
+        await asyncio.sleep(0.01)  # let the handlers send their 503s before the server stops
+
+def install_sigterm_handler():
+    """Chains in front of the server's own SIGTERM handler: drain first, then let it shut down."""
+    if threading.current_thread() is not threading.main_thread():
+        return  # signal handlers can only be set from the main thread (e.g. not under TestClient)
+    loop = asyncio.get_running_loop()
+    previous = signal.getsignal(signal.SIGTERM)
+    lifecycle["previous_sigterm"] = previous
+
+    async def drain_then_exit(signum, frame):
+        await drain(DRAIN_DEADLINE)
+        if callable(previous):
+            previous(signum, frame)
+        else:
+            signal.signal(signal.SIGTERM, previous)
+            signal.raise_signal(signal.SIGTERM)
+
+    def start_drain(signum, frame):
+        if lifecycle["draining"]:
+            return
+        lifecycle["draining"] = True
+        lifecycle["ready"] = False
+        lifecycle["drain"] = loop.create_task(drain_then_exit(signum, frame))
+
+    def on_sigterm(signum, frame):
+        # Runs between arbitrary bytecodes; hand off to the loop (and wake its selector) instead of touching it here.
+        loop.call_soon_threadsafe(start_drain, signum, frame)
+
+    signal.signal(signal.SIGTERM, on_sigterm)
+
+def restore_sigterm_handler():
+    if lifecycle["previous_sigterm"] is not None and threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, lifecycle["previous_sigterm"])
+
+def require_admin(x_admin_token: Optional[str]):
+    if not PROFILING_TOKEN:
+        raise HTTPException(status_code=404, detail="Profiling is disabled")
+    # Compare bytes: str compare_digest raises TypeError on non-ASCII (headers arrive as latin-1).
+    if not x_admin_token or not hmac.compare_digest(x_admin_token.encode(), PROFILING_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Forbidden: Invalid Admin Token")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    loop_thread_id = threading.get_ident()
+    profiling["loop_thread_id"] = loop_thread_id
+    if PROFILING_TOKEN:
+        profiling["background"] = StackSampler(loop_thread_id, BACKGROUND_SAMPLE_INTERVAL, BACKGROUND_MAX_SAMPLES).start()
+    profiling["loop_lag"] = LoopLagMonitor(loop_thread_id, LOOP_LAG_INTERVAL, LOOP_LAG_THRESHOLD).start()
+    lifecycle.update(fresh_lifecycle())
+    install_sigterm_handler()
+    lifecycle["warm_up"] = asyncio.create_task(warm_up())
+    yield
+    lifecycle["draining"] = True
+    lifecycle["ready"] = False
+    if lifecycle["in_flight"]:
+        await drain(DRAIN_DEADLINE)
+    await lifecycle["warm_up"]
+    if lifecycle["keep_warm"]:
+        lifecycle["keep_warm"].cancel()
+    if lifecycle["http_client"]:
+        await lifecycle["http_client"].aclose()
+        lifecycle["http_client"] = None
+    restore_sigterm_handler()
+    await profiling["loop_lag"].stop()
+    if profiling["background"]:
+        profiling["background"].stop()
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -38,6 +344,86 @@ class InvoiceRequest(BaseModel):
     buyer_type: str
     scenario_id: str # We enforce that this must be sent
 
+async def profile_request(request: Request, call_next):
+    # Opt-in per request: send "X-Profile: 1" together with a valid "X-Admin-Token".
+    # The sampler watches the whole event-loop thread, so concurrent requests show up too.
+    if not request.headers.get("x-profile") or profiling["loop_thread_id"] is None:
+        return await call_next(request)
+    try:
+        require_admin(request.headers.get("x-admin-token"))
+    except HTTPException:
+        return await call_next(request)
+
+    sampler = StackSampler(profiling["loop_thread_id"], REQUEST_SAMPLE_INTERVAL, REQUEST_MAX_SAMPLES).start()
+    try:
+        response = await call_next(request)
+    finally:
+        sampler.stop()
+
+    profile_id = uuid.uuid4().hex
+    request_profiles[profile_id] = sampler.folded()
+    while len(request_profiles) > MAX_REQUEST_PROFILES:
+        request_profiles.popitem(last=False)
+    response.headers["X-Profile-Id"] = profile_id
+    return response
+
+# Only wrap requests when profiling is possible; otherwise keep the submission path untouched.
+if PROFILING_TOKEN:
+    app.middleware("http")(profile_request)
+
+# --- ADMIN: PROFILE DOWNLOADS ---
+# All responses are collapsed stacks: pipe into flamegraph.pl or drop into speedscope.app.
+@app.get("/admin/profiles")
+async def list_profiles(x_admin_token: Optional[str] = Header(None)):
+    require_admin(x_admin_token)
+    background = profiling["background"]
+    return {
+        "request_profiles": list(request_profiles),
+        "background_samples": len(background.samples) if background else 0,
+        "background_interval_s": BACKGROUND_SAMPLE_INTERVAL,
+    }
+
+@app.get("/admin/profiles/background", response_class=PlainTextResponse)
+async def download_background_profile(x_admin_token: Optional[str] = Header(None)):
+    require_admin(x_admin_token)
+    background = profiling["background"]
+    return background.folded() if background else ""
+
+@app.get("/admin/profiles/{profile_id}", response_class=PlainTextResponse)
+async def download_request_profile(profile_id: str, x_admin_token: Optional[str] = Header(None)):
+    require_admin(x_admin_token)
+    if profile_id not in request_profiles:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return request_profiles[profile_id]
+
+@app.get("/admin/loop-lag")
+async def loop_lag_events(x_admin_token: Optional[str] = Header(None)):
+    require_admin(x_admin_token)
+    monitor = profiling["loop_lag"]
+    return {
+        "threshold_ms": LOOP_LAG_THRESHOLD * 1000,
+        "events": list(monitor.events) if monitor else [],
+    }
+
+# --- HEALTH ---
+@app.get("/health")
+async def liveness():
+    return {"status": "alive"}
+
+@app.get("/ready")
+async def readiness():
+    body = {
+        "ready": lifecycle["ready"],
+        "draining": lifecycle["draining"],
+        "in_flight": len(lifecycle["in_flight"]),
+        "ready_after_s": lifecycle["ready_after_s"],
+        "first_request_after_s": lifecycle["first_request_after_s"],
+    }
+    if not lifecycle["ready"]:
+        raise HTTPException(status_code=503, detail=body)
+    return body
+
+@lru_cache(maxsize=1)  # env vars don't change while the worker runs; parse once
 def get_client_config():
     config_str = os.getenv("CLIENT_CONFIG")
     if not config_str: return {}
@@ -48,7 +434,12 @@ def get_client_config():
 
 @app.post("/submit-invoice")
 async def submit_invoice(invoice: InvoiceRequest, x_client_id: str = Header(...)):
-    
+
+    # 0. Refuse new work while shutting down
+    if lifecycle["draining"]:
+        raise HTTPException(status_code=503, detail="Server restarting: resubmit shortly", headers={"Retry-After": RETRY_AFTER_S})
+    record_first_request()
+
     # 1. Validate Client
     client_db = get_client_config()
     if x_client_id not in client_db:
@@ -105,7 +496,6 @@ async def submit_invoice(invoice: InvoiceRequest, x_client_id: str = Header(...)
     }
 
     # 3. Send to FBR
-    fbr_url = "https://gw.fbr.gov.pk/di_data/v1/di/postinvoicedata_sb"
     headers = {
         "Authorization": f"Bearer {client_settings['auth_token']}",
         "Content-Type": "application/json"
@@ -113,27 +503,39 @@ async def submit_invoice(invoice: InvoiceRequest, x_client_id: str = Header(...)
 
     print(f"🚀 DYNAMIC PAYLOAD: {json.dumps(fbr_payload, indent=2)}") 
 
-    async with httpx.AsyncClient() as client:
+    try:
+        client = await get_http_client()
+        fbr_call = asyncio.create_task(client.post(FBR_URL, json=fbr_payload, headers=headers))
+        lifecycle["in_flight"][fbr_call] = invoice.invoice_id
         try:
-            response = await client.post(fbr_url, json=fbr_payload, headers=headers, timeout=30.0)
-            
-            try:
-                fbr_response = response.json()
-            except:
-                return {"status": "failed", "message": f"FBR Error {response.status_code}: {response.text}"}
-            
-            if "validationResponse" in fbr_response:
-                val_resp = fbr_response["validationResponse"]
-                if val_resp.get("status") == "Valid":
-                    return {
-                        "status": "success",
-                        "fbr_invoice_number": fbr_response.get("invoiceNumber", "VERIFIED"),
-                        "message": "Verified by FBR"
-                    }
-                else:
-                    return {"status": "failed", "message": val_resp.get("error", "Validation Failed")}
-            
-            return {"status": "failed", "message": fbr_response.get("Message", "Unknown Error")}
+            response = await fbr_call
+        except asyncio.CancelledError:
+            if fbr_call not in lifecycle["requeued"]:
+                raise
+            lifecycle["requeued"].discard(fbr_call)
+            raise HTTPException(status_code=503, detail="Server restarting: resubmit invoice (FBR may already have it, check invoiceRefNo)", headers={"Retry-After": RETRY_AFTER_S})
+        finally:
+            lifecycle["in_flight"].pop(fbr_call, None)
 
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Connection Failed: {str(e)}")
+        try:
+            fbr_response = response.json()
+        except:
+            return {"status": "failed", "message": f"FBR Error {response.status_code}: {response.text}"}
+        
+        if "validationResponse" in fbr_response:
+            val_resp = fbr_response["validationResponse"]
+            if val_resp.get("status") == "Valid":
+                return {
+                    "status": "success",
+                    "fbr_invoice_number": fbr_response.get("invoiceNumber", "VERIFIED"),
+                    "message": "Verified by FBR"
+                }
+            else:
+                return {"status": "failed", "message": val_resp.get("error", "Validation Failed")}
+        
+        return {"status": "failed", "message": fbr_response.get("Message", "Unknown Error")}
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Connection Failed: {str(e)}")